@@ -2,14 +2,14 @@ from __future__ import annotations
 
 import asyncio
 import logging
-import json
 import uuid
 import warnings
 
-from typing import Optional, Union, Any, Dict
+from typing import Optional, Union, Any, Dict, Callable, Literal
 from websockets.client import connect, WebSocketClientProtocol 
 from .objects import ServerResponse
 from .errors import ServerTimeout
+from .utils import HAS_MSGPACK, _to_json_bytes, _from_json, _to_msgpack, _from_msgpack
 
 class Client:
     """
@@ -29,6 +29,9 @@ class Client:
         Should the client perform standard or multicast connection (this is enable by default)
     timeout: `Optional[int]`
         How long should each request take before raising `Timeout` exceptiom
+    wire_format: `str`
+        The format used to encode messages, either "json" or "msgpack" (the default is "json").
+        This has to match the format of the server, "msgpack" requires the msgpack package.
     """
 
     def __init__(
@@ -38,7 +41,8 @@ class Client:
         standard_port: int = 1025,
         multicast_port: int = 20000,
         do_multicast: bool = True,
-        timeout: Optional[int] = None
+        timeout: Optional[int] = None,
+        wire_format: Literal["json", "msgpack"] = "json"
     ) -> None:
         self.host = host
         self.standard_port = standard_port
@@ -46,6 +50,19 @@ class Client:
         self.multicast_port = multicast_port
         self.do_multicast = do_multicast
         self.timeout = timeout
+        self.wire_format = wire_format
+
+        if wire_format == "json":
+            self._encode: Callable[[Any], bytes] = _to_json_bytes
+            self._decode: Callable[[Union[str, bytes]], Any] = _from_json
+        elif wire_format == "msgpack":
+            if not HAS_MSGPACK:
+                raise RuntimeError("You must have msgpack installed to use the msgpack wire format.")
+
+            self._encode = _to_msgpack
+            self._decode = _from_msgpack
+        else:
+            raise ValueError(f"Unknown wire format {wire_format!r}, expected 'json' or 'msgpack'.")
 
         self.id = uuid.uuid4()
         self.logger = logging.getLogger(__name__)
@@ -77,34 +94,30 @@ class Client:
             warnings.warn("Multicast will replace normal connection in the future!", PendingDeprecationWarning)
 
             if not self.connection:
-                self.connection = await connect(self.url, extra_headers={"ID": str(self.id)})
+                self.connection = await connect(self.url, extra_headers={"ID": str(self.id)}, compression=None)
         
-            await self.connection.send(json.dumps({
+            await self.connection.send(self._encode({
                 "endpoint": endpoint,
                 "secret": str(self.secret_key),
-                "kwargs": {
-                    **kwargs
-                },
+                "kwargs": kwargs,
             }))
             
             
             async with self.lock:
                 try:
-                    return ServerResponse(await asyncio.wait_for(self.connection.recv(), self.timeout)) # type: ignore
+                    return ServerResponse(self._decode(await asyncio.wait_for(self.connection.recv(), self.timeout))) # type: ignore
                 except asyncio.TimeoutError:
                     raise ServerTimeout(f"The server response took longer than the maximum timeout!", self.timeout) # type: ignore
         
-        async with connect(self.url) as conn:
-            await conn.send(json.dumps({
+        async with connect(self.url, compression=None) as conn:
+            await conn.send(self._encode({
                 "endpoint": endpoint,
                 "secret": str(self.secret_key),
-                "kwargs": {
-                    **kwargs
-                },
+                "kwargs": kwargs,
             }))
             
             try:
-                return ServerResponse(await asyncio.wait_for(conn.recv(), self.timeout)) # type: ignore
+                return ServerResponse(self._decode(await asyncio.wait_for(conn.recv(), self.timeout))) # type: ignore
             except asyncio.TimeoutError:
                 raise ServerTimeout(f"The server response took longer than the maximum timeout!", self.timeout) # type: ignore
 
@@ -1,7 +1,8 @@
-import json
 import enum
 from typing import Dict, Any, Optional, Union
 
+from .utils import _from_json
+
 class StatusEnum(enum.Enum):
     OK = 200
     FORBIDDEN = 403
@@ -36,6 +37,8 @@ class ClientPayload:
         The kwargs from the payload.
     """
 
+    __slots__ = ("payload", "length", "endpoint", "data")
+
     def __init__(self, payload: Dict[str, Any]):
         self.payload = payload
         self.length: int = len(payload)
@@ -48,14 +51,13 @@ class ClientPayload:
     def __contains__(self, __o: object) -> bool:
         return __o in self.data or __o in self.data.values() # type: ignore
 
-    def __getattribute__(self, __name: str) -> Any:
+    def __getattr__(self, __name: str) -> Any:
+        # only called when normal lookup fails, so regular attributes
+        # don't pay for the fallback to the kwargs
         try:
-            return object.__getattribute__(self, __name)
-        except AttributeError:
-            try:
-                return self.data[__name] # type: ignore
-            except KeyError:
-                raise AttributeError(__name)
+            return object.__getattribute__(self, "data")[__name]
+        except (KeyError, TypeError):
+            raise AttributeError(__name)
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} length={self.length} endpoint={self.endpoint!r}>"
@@ -77,8 +79,8 @@ class ServerResponse:
 
     Parameters:
     ----------
-    payload: `str`
-        The payload to be converted.
+    payload: `str | bytes | Dict`
+        The payload to be converted, either raw JSON or an already decoded message.
 
     Attributes
     ----------
@@ -89,8 +91,8 @@ class ServerResponse:
     status: `StatusEnum`
         Raw status code converted to readable data.
     """
-    def __init__(self, payload: str):
-        self.data: Dict[str, Any] = json.loads(payload)
+    def __init__(self, payload: Union[str, bytes, Dict[str, Any]]):
+        self.data: Dict[str, Any] = payload if isinstance(payload, dict) else _from_json(payload)
         self.decoding: str = self.data["decoding"]
 
     def __repr__(self) -> str:
@@ -104,7 +106,7 @@ class ServerResponse:
 
         """
         if self.decoding == "JSON":
-            return json.loads(self.data["response"])
+            return _from_json(self.data["response"])
         return self.data["response"]
 
     @property
@@ -2,18 +2,19 @@ from __future__ import annotations
 import asyncio
 
 import logging
-import json
 import contextlib
 import inspect
+import hmac
 
 from disnake.ext.commands import Bot, Cog
-from typing import TYPE_CHECKING, Optional, Callable, ClassVar, TypeVar, Union, Type, Awaitable, Tuple, Any, Dict
+from typing import TYPE_CHECKING, Optional, Callable, ClassVar, TypeVar, Union, Type, Awaitable, Tuple, Any, Dict, Literal, Set
 
 from websockets.exceptions import ConnectionClosedError, ConnectionClosed
 from websockets.server import WebSocketServerProtocol, WebSocketServer, serve
 
 from .errors import InvalidReturn, NoEndpointFound, MulticastFailure, ServerAlreadyStarted
 from .objects import ClientPayload
+from .utils import HAS_MSGPACK, _to_json, _from_json, _to_msgpack, _from_msgpack
 
 
 if TYPE_CHECKING:
@@ -45,10 +46,38 @@ class Server:
         Should the multicasting be allowed (this is enabled by default).
     logger: `Logger`
         You can specify the logger for logs related to the lib (the default is discord.ext.ipc.server)
+    max_concurrency: `int`
+        How many requests can be handled at the same time (the default is 32).
+    wire_format: `str`
+        The format used to encode messages, either "json" or "msgpack" (the default is "json").
+        Clients have to use the same format, "msgpack" requires the msgpack package.
     """
 
     endpoints: ClassVar[Dict[str, Tuple[RouteFunc, Type[ClientPayload]]]] = {}
 
+    # responses that never change, encoded once per server in the wire format
+    _UNAUTHORIZED: ClassVar[Dict[str, Any]] = {
+        "decoding": None,
+        "code": 403,
+        "response": None,
+        "error": "Unauthorized",
+        "error_details": "You're trying to connect with an invalid secret key!"
+    }
+    _UNKNOWN_ENDPOINT: ClassVar[Dict[str, Any]] = {
+        "decoding": None,
+        "code": 404,
+        "response": None,
+        "error": "Unknown endpoint!",
+        "error_details": "The route that you're trying to call doesn't exist!"
+    }
+    _NOT_MULTICAST: ClassVar[Dict[str, Any]] = {
+        "decoding": None,
+        "code": 500,
+        "response": None,
+        "error": "The requested route is not available for multicast connections!",
+        "error_details": "This route can only be called with standart client!"
+    }
+
     def __init__(
         self,
         bot: Bot,
@@ -57,7 +86,9 @@ class Server:
         standard_port: int = 1025,
         multicast_port: int = 20000,
         do_multicast: bool = True,
-        logger: Optional[logging.Logger] = None
+        logger: Optional[logging.Logger] = None,
+        max_concurrency: int = 32,
+        wire_format: Literal["json", "msgpack"] = "json"
     ) -> None:
         self.bot = bot
         self.host = host
@@ -65,17 +96,60 @@ class Server:
         self.standard_port = standard_port
         self.multicast_port = multicast_port
         self.do_multicast = do_multicast
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+
+        self.max_concurrency = max_concurrency
+        self.wire_format = wire_format
+
+        if wire_format == "json":
+            self._encode: Callable[[Any], Union[str, bytes]] = _to_json
+            self._decode: Callable[[Union[str, bytes]], Any] = _from_json
+        elif wire_format == "msgpack":
+            if not HAS_MSGPACK:
+                raise RuntimeError("You must have msgpack installed to use the msgpack wire format.")
+
+            self._encode = _to_msgpack
+            self._decode = _from_msgpack
+        else:
+            raise ValueError(f"Unknown wire format {wire_format!r}, expected 'json' or 'msgpack'.")
+
+        self._unauthorized_response = self._encode(self._UNAUTHORIZED)
+        self._unknown_endpoint_response = self._encode(self._UNKNOWN_ENDPOINT)
+        self._not_multicast_response = self._encode(self._NOT_MULTICAST)
 
         self.logger = logger or logging.getLogger(__name__)
         self.servers: Dict[str, WebSocketServer] = {}
         self.connection: Optional[Tuple[str, WebSocketServerProtocol]] = None
+        self._reserved_response: Optional[Union[str, bytes]] = None
+        self._cls_cache: Dict[str, Tuple[RouteFunc, Union[Cog, Bot]]] = {}
+        self._in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} endpoints={len(self.endpoints)} started={self.started} standard_port={self.standard_port!r} multicast_port={self.multicast_port!r} do_multicast={self.do_multicast}>"
 
     def get_cls(self, func: RouteFunc) -> Union[Cog, Bot]:
+        # cogs can be (re)loaded at any time, so a cached cog is only
+        # trusted while it is still the one registered under its name.
+        # entries are keyed by qualname so a reloaded route replaces the
+        # old one instead of keeping the unloaded cog alive
+        key = func.__qualname__
+
+        if (cached := self._cls_cache.get(key)) is not None:
+            cached_func, cls = cached
+
+            if cached_func is func and (cls is self.bot or self.bot.cogs.get(cls.qualified_name) is cls):
+                return cls
+            del self._cls_cache[key]
+
+        if getattr(type(self.bot), func.__name__, None) is func:
+            self._cls_cache[key] = func, self.bot
+            return self.bot
+
         for cog in self.bot.cogs.values():
             if func.__name__ in dir(cog):
+                self._cls_cache[key] = func, cog
                 return cog
         return self.bot
 
@@ -105,80 +179,101 @@ class Server:
             return func
         return decorator
 
+    @property
+    def secret_key(self) -> Union[str, None]:
+        return self._secret_key
+
+    @secret_key.setter
+    def secret_key(self, value: Union[str, None]) -> None:
+        # kept as bytes so each request is compared in constant time without re-encoding
+        self._secret_key = value
+        self._secret_key_bytes = str(value).encode("utf-8", "surrogatepass")
+
     @property
     def started(self) -> bool:
         return len(self.servers) > 0
 
-    def is_secure(self, message: Union[str, bytes]) -> bool:
-        data: Dict[str, Any] = json.loads(message)
+    def is_secure(self, message: Union[str, bytes, Dict[str, Any]]) -> bool:
+        data: Dict[str, Any] = message if isinstance(message, dict) else self._decode(message)
 
         if (key := data.get("secret")):
-            return str(key) == str(self.secret_key)
+            return hmac.compare_digest(str(key).encode("utf-8", "surrogatepass"), self._secret_key_bytes)
         return bool(self.secret_key is None)
     
 
     async def handle_request(self, websocket: WebSocketServerProtocol, message: Union[str, bytes], multucast: bool = True) -> None:
-        payload: Dict[str, Union[str, int, None]] = {
-            "decoding": None,
-            "code": 200,
-            "response": None
-        }
-        
-        if not self.is_secure(message):
-            payload["code"] = 403
-            payload["error"] = "Unauthorized"
-            payload["error_details"] = "You're trying to connect with an invalid secret key!"
-            return await websocket.send(json.dumps(payload))
+        return await websocket.send(await self._process_request(message, multucast))
+
+    async def _process_request(self, message: Union[str, bytes], multucast: bool = True) -> Union[str, bytes]:
+        # decoded once here, the decoders accept bytes frames directly
+        data: Dict[str, Any] = self._decode(message)
+
+        if not self.is_secure(data):
+            return self._unauthorized_response
 
-        data: Dict[str, Any] = json.loads(message)
         endpoint: str = data["endpoint"]
 
         if not (coro := self.endpoints.get(endpoint)):
-            payload["code"] = 404
-            payload["error"] = "Unknown endpoint!"
-            payload["error_details"] = "The route that you're trying to call doesn't exist!"
             self.bot.dispatch("ipc_error", None, NoEndpointFound(endpoint, "The route that you're trying to call doesn't exist!"))
-            return await websocket.send(json.dumps(payload))
-        
-        try:
-            func = coro[0]
+            return self._unknown_endpoint_response
 
-            if multucast and not func.__getattribute__("__multicast__"):
-                payload["code"] = 500
-                payload["error"] = "The requested route is not available for multicast connections!"
-                payload["error_details"] = "This route can only be called with standart client!"
-                self.bot.dispatch("ipc_error", endpoint, MulticastFailure(endpoint, "This route can only be called with standart client!"))
-                return await websocket.send(json.dumps(payload))
+        func, payload_cls = coro
+
+        if multucast and not func.__multicast__:
+            self.bot.dispatch("ipc_error", endpoint, MulticastFailure(endpoint, "This route can only be called with standart client!"))
+            return self._not_multicast_response
 
-            resp: Optional[Union[Dict, str]] = await func(self.get_cls(func), coro[1](data))
+        payload: Dict[str, Any] = {
+            "decoding": None,
+            "code": 200,
+            "response": None
+        }
+
+        try:
+            resp: Optional[Union[Dict, str]] = await func(self.get_cls(func), payload_cls(data))
         except Exception as exc:
             payload["code"] = 500
             payload["error"] = "Unexpected error occurred while calling the route!"
             payload["error_details"] = str(exc)
 
             self.bot.dispatch("ipc_error", endpoint, exc)
-            return await websocket.send(json.dumps(payload))
+            return self._encode(payload)
         
-        if resp and not (isinstance(resp, Dict) or isinstance(resp, str)):
+        if isinstance(resp, dict):
+            try:
+                if self.wire_format == "msgpack":
+                    # msgpack carries the dict as it is, no nested encoding needed
+                    payload["response"] = resp
+                    return self._encode(payload)
+
+                payload["response"] = _to_json(resp)
+            except (TypeError, ValueError) as exc:
+                payload["response"] = None
+                payload["code"] = 500
+                payload["error"] = "The route returned a response that can't be serialized!"
+                payload["error_details"] = str(exc)
+                self.bot.dispatch("ipc_error", endpoint, InvalidReturn(endpoint, str(exc)))
+                return self._encode(payload)
+
+            payload["decoding"] = "JSON"
+        elif resp and not isinstance(resp, str):
             payload["error"] = f"Expected type Dict or string as response, got {resp.__class__.__name__!r} instead!"
             payload["code"] = 500
             self.bot.dispatch("ipc_error", endpoint, InvalidReturn(endpoint, f"Expected type Dict or string as response, got {resp.__class__.__name__} instead!"))
-            return await websocket.send(json.dumps(payload))
-        
-        if isinstance(resp, Dict):
-            payload["decoding"] = "JSON"
-            payload["response"] = json.dumps(resp)
+            return self._encode(payload)
         else:
             payload["response"] = resp
         
-        return await websocket.send(json.dumps(payload))
+        return self._encode(payload)
 
     async def create_server(self, name: str, port: int, ws_handler: Handler) -> None:
         if name in self.servers:
             raise ServerAlreadyStarted(name, f"{name!r} is already started!")
         
-        self.servers[name] = await serve(ws_handler, self.host, port)
-        self.logger.debug(f"{name.title()} is ready for use!")
+        # IPC traffic stays on a trusted, usually local link where
+        # permessage-deflate costs more CPU than it saves in bandwidth
+        self.servers[name] = await serve(ws_handler, self.host, port, compression=None)
+        self.logger.debug("%s is ready for use!", name.title())
 
     async def standart_handler(self, websocket: WebSocketServerProtocol) -> None:
         id = websocket.request_headers["ID"]
@@ -186,36 +281,117 @@ class Server:
         try:
             if self.connection:
                 if not self.connection[0] == id:
-                    resp = json.dumps({
-                        "error": "Connection already reserved!",
-                        "details": self.connection[0],
-                        "code": 422
-                    })
-                    
-                    return await websocket.send(resp)
+                    return await websocket.send(self._reserved_response) # type: ignore
             else:
-                self.logger.debug(f"New connection created: {id}")
+                self.logger.debug("New connection created: %s", id)
                 self.connection = id, websocket
-        
-            async for message in websocket:
-                with contextlib.suppress(ConnectionClosedError, ConnectionClosed):
-                    await asyncio.create_task(self.handle_request(websocket, message, False))
-            
+                # the rejection only depends on who holds the connection,
+                # so encode it once for as long as they hold it
+                self._reserved_response = self._encode({
+                    "error": "Connection already reserved!",
+                    "details": id,
+                    "code": 422
+                })
+
+            await self._read_requests(websocket)
         except (ConnectionClosedError, ConnectionClosed):
-            self.logger.debug(f"Connection closed by the client: {self.connection[0]}") # type: ignore
-            self.connection = None
+            self.logger.debug("Connection closed by the client: %s", id)
+        finally:
+            if self.connection and self.connection[0] == id:
+                self.connection = None
+
+    async def _read_requests(self, websocket: WebSocketServerProtocol) -> None:
+        queue: asyncio.Queue[asyncio.Task[Union[str, bytes]]] = asyncio.Queue(maxsize=256)
+        writer = asyncio.create_task(self._writer(websocket, queue))
+        pending: Set[asyncio.Task[Union[str, bytes]]] = set()
+
+        try:
+            async for message in websocket:
+                # waiting for a free slot before reading on keeps slow
+                # routes from piling up an unbounded amount of work
+                await self._acquire()
+                task = asyncio.create_task(self._dispatch(message, False))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+                if queue.full():
+                    # the writer is the only consumer, so stop reading
+                    # instead of waiting on a queue nobody drains anymore
+                    put = asyncio.ensure_future(queue.put(task))
+                    await asyncio.wait((put, writer), return_when=asyncio.FIRST_COMPLETED)
+
+                    if not put.done():
+                        put.cancel()
+                        break
+                else:
+                    queue.put_nowait(task)
+
+                if writer.done():
+                    break
+        finally:
+            writer.cancel()
+
+            # responses can't be delivered anymore, but the routes are left
+            # to finish so they release their slots and their errors are retrieved
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
     
+    async def _acquire(self) -> None:
+        async with self._condition: # type: ignore
+            await self._condition.wait_for(lambda: self._in_flight < self.max_concurrency) # type: ignore
+            self._in_flight += 1
+
+    async def _release(self) -> None:
+        async with self._condition: # type: ignore
+            self._in_flight -= 1
+            self._condition.notify(1) # type: ignore
+
+    async def _dispatch(self, message: Union[str, bytes], multucast: bool) -> Union[str, bytes]:
+        try:
+            return await self._process_request(message, multucast)
+        finally:
+            await self._release()
+
+    async def _writer(self, websocket: WebSocketServerProtocol, queue: asyncio.Queue[asyncio.Task[Union[str, bytes]]]) -> None:
+        # requests run concurrently but the client matches responses by
+        # order, so they are written one frame each in the order received
+        with contextlib.suppress(ConnectionClosedError, ConnectionClosed):
+            while True:
+                task = await queue.get()
+
+                try:
+                    # shielded so cancelling the writer doesn't cancel the route
+                    resp = await asyncio.shield(task)
+                except Exception:
+                    self.logger.exception("Failed to handle IPC request")
+                    return await websocket.close(1011)
+
+                await websocket.send(resp)
+
     async def multicast_handler(self, websocket: WebSocketServerProtocol) -> None:
         with contextlib.suppress(ConnectionClosedError, ConnectionClosed):
             async for message in websocket:
-                await asyncio.create_task(self.handle_request(websocket, message, True))
+                # the slot only covers the route, a client that is slow to
+                # read its response shouldn't hold one of the shared slots
+                await self._acquire()
+                await websocket.send(await self._dispatch(message, True))
 
     async def start(self) -> None:
         """|coro|
         
         Starts all necessary processes for the servers and runners to work properly
 
+        The servers are started on the running event loop, which has to be the bot's
+        loop since routes are called directly and use the bot's state and HTTP session.
+
         """
+        for func, _ in self.endpoints.values():
+            self.get_cls(func)
+
+        # created once, requests may still be waiting on it if start() is called again
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
         await self.create_server("standard", self.standard_port, self.standart_handler)
 
         if self.do_multicast:
@@ -223,6 +399,26 @@ class Server:
 
         self.bot.dispatch("ipc_ready")
     
+    async def set_max_concurrency(self, value: int) -> None:
+        """|coro|
+
+        Changes how many requests can be handled at the same time.
+        Requests that are already running are not affected.
+
+        Parameters
+        ----------
+        value: :class:`int`
+            The new limit, has to be at least 1.
+        """
+        if value < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+
+        self.max_concurrency = value
+
+        if self._condition:
+            async with self._condition:
+                self._condition.notify_all()
+
     async def stop(self) -> None:
         """|coro|
 
@@ -232,6 +428,6 @@ class Server:
         for name, server in self.servers.items():
             server.close()
             await server.wait_closed()
-            self.logger.info(f"{name!r} server has been stopped!")
+            self.logger.info("%r server has been stopped!", name)
         
         self.servers = {}
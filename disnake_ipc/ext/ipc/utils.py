@@ -0,0 +1,58 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    HAS_ORJSON = False
+else:
+    HAS_ORJSON = True
+
+    # non-str keys are accepted and datetimes/dataclasses are rejected
+    # so the same values are encodable as with the json module
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+try:
+    import msgpack
+except ImportError:
+    HAS_MSGPACK = False
+else:
+    HAS_MSGPACK = True
+
+
+def _to_json(obj: Any) -> str:
+    if HAS_ORJSON:
+        # ints over 64 bits are rejected rather than handed to the json module,
+        # orjson clients would silently decode them as floats
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS).decode("utf-8")
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=True)
+
+
+def _to_json_bytes(obj: Any) -> bytes:
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=True).encode("utf-8")
+
+
+def _from_json(data: Union[str, bytes]) -> Any:
+    if HAS_ORJSON:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # json accepts some input orjson doesn't (e.g. lone surrogate escapes)
+            # and raises its own error for anything that really is invalid
+            pass
+    return json.loads(data)
+
+
+def _to_msgpack(obj: Any) -> bytes:
+    try:
+        return msgpack.packb(obj)
+    except OverflowError as exc:
+        # ints msgpack can't represent are reported like any other unserializable value
+        raise TypeError(str(exc)) from exc
+
+
+def _from_msgpack(data: bytes) -> Any:
+    # non-str keys are allowed so dicts round-trip like they do through json
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
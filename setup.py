@@ -51,6 +51,10 @@ setuptools.setup(
     keywords=["better-ipc", "ipc", "python", "disnake"],
     long_description=long_description,
     install_requires=requirements,  # Corrected the parameter name from 'dependencies' to 'install_requires'
+    extras_require={
+        "speed": ["orjson>=3.5.4", "uvloop>=0.17.0; sys_platform != 'win32'"],
+        "msgpack": ["msgpack>=1.0.0"],
+    },
     name="better-ipc-disnake",
     version=version,
 )